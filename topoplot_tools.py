@@ -3,11 +3,28 @@
 Scripts to plot images in a topoplot
 """
 
+import math
+import os
 import numpy as np
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from PIL import ImageDraw
 
+# degrees <-> radians conversion factors
+_D2R = math.pi / 180.0
+_R2D = 180.0 / math.pi
+
+def _is_float(value):
+    '''
+    True if the text 'value' can be converted to float
+    '''
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
 def read_csv_position(filename, xyz_format='default'):
     '''
     Reads a text file CSV or tab-separated with the position information for the electrodes
@@ -17,6 +34,8 @@ def read_csv_position(filename, xyz_format='default'):
         Geographic / Spetical coodinates as in EEGLab (sph_theta, sph_phi, sph_radius)
     
     The text file has to have headers
+    Files with extension .sph or .xyz are read as tab-separated (or space-separated if there are no tabs),
+    the delimiter of other files is detected
     
     Parameters
     ----------
@@ -36,57 +55,84 @@ def read_csv_position(filename, xyz_format='default'):
     info_electrodes : List of dictionaries with the position information for each electrode
     
     '''
-    # detect delimiter and presence of headers
+    # detect delimiter and presence of headers, and read rows, in a single pass
+    # .sph and .xyz files are tab-separated (or space-separated), no need to sniff them
+    ext = os.path.splitext(filename)[1].lower()
     with open(filename, 'r') as csvfile:
-        dialect = csv.Sniffer().sniff(csvfile.read(1024))
-        csvfile.seek(0)
-        reader = csv.reader(csvfile, dialect)
-        has_header = csv.Sniffer().has_header(csvfile.read(1024))
+        if ext in ('.sph', '.xyz'):
+            lines = [line for line in csvfile if line.strip()]
+            if lines and '\t' in lines[0]:
+                # tab-separated, empty fields are kept so columns do not shift
+                rows = list(csv.reader(lines, csv.excel_tab))
+            else:
+                rows = [line.split() for line in lines]
+            headers = rows[0] if rows else []
+            rows = rows[1:]
+            # the first row is taken as headers if none of its fields is a number
+            has_header = len(headers) > 0 and not any(_is_float(header) for header in headers)
+        else:
+            sample = csvfile.read(2048)
+            csvfile.seek(0)
+            dialect = csv.Sniffer().sniff(sample)
+            has_header = csv.Sniffer().has_header(sample)
+            if has_header:
+                reader = csv.reader(csvfile, dialect)
+                # read headers
+                headers = next(reader)
+                rows = list(reader)
     
     if not has_header:
         print('The provided CSV has not headers')
         return 
     
-    # read headers
-    reader = csv.reader(open(filename, 'r'), dialect=dialect)
-    headers = reader.__next__()
+    for i_row, row in enumerate(rows):
+        if len(row) < len(headers):
+            raise ValueError('Row %d of %s has %d fields, expected %d as in the headers'
+                             % (i_row + 1, filename, len(row), len(headers)))
+    
     header_tuples = []
     for ix, header in enumerate(headers):
         if header != '':
             header_tuples.append((ix, header))
     
     # electrode information to dictionary
-    info_electrodes = []
-    for row in reader:
-        d = {}
-        for header_tuple in header_tuples:
-            try:
-                d[header_tuple[1]] = float(row[header_tuple[0]])
-            except:
-                d[header_tuple[1]] = row[header_tuple[0]]    
-        info_electrodes.append(d)
+    # each column is converted to float at once, columns that are not numeric are kept as text
+    columns = {}
+    for ix, header in header_tuples:
+        column = [row[ix] for row in rows]
+        try:
+            columns[header] = np.array(column, dtype=np.float64).tolist()
+        except ValueError:
+            columns[header] = column
+    info_electrodes = [dict(zip(columns, values)) for values in zip(*columns.values())]
     
     # verify fields for geographic coordinates (sph_theta, sph_phi, sph_radius)
     if 'sph_phi' in info_electrodes[0] and 'sph_theta' in info_electrodes[0]:
         if not 'sph_radius' in info_electrodes[0]:
-            for info_electrode in info_electrodes:
-                info_electrode['sph_radius'] = 1
+            rads = np.ones(len(info_electrodes))
+            for info_electrode, rad in zip(info_electrodes, rads):
+                info_electrode['sph_radius'] = rad
         return info_electrodes
     
     if 'X' in info_electrodes[0] and 'Y' in info_electrodes[0] and 'Z' in info_electrodes[0]:
-        for info_electrode in info_electrodes:
-            x = info_electrode['X']
-            y = info_electrode['Y']
-            z = info_electrode['Z']
-            # XYZ, to geographic / spherical coordinates
-            r_xy = np.sqrt(x**2 + y**2)
-            if xyz_format == 'default':
-                info_electrode['sph_theta'] = np.arctan2(x, y) * 180 / np.pi
-            elif xyz_format == 'EEGLab':    
-                info_electrode['sph_theta'] = np.arctan2(y, x) * 180 / np.pi
-            
-            info_electrode['sph_phi'] = np.arctan2(z, r_xy) * 180 / np.pi
-            info_electrode['sph_radius'] = 1
+        xs = np.fromiter((e['X'] for e in info_electrodes), dtype=np.float64)
+        ys = np.fromiter((e['Y'] for e in info_electrodes), dtype=np.float64)
+        zs = np.fromiter((e['Z'] for e in info_electrodes), dtype=np.float64)
+        # XYZ, to geographic / spherical coordinates, all electrodes at once
+        r_xy = np.hypot(xs, ys)
+        if xyz_format == 'default':
+            thetas = np.degrees(np.arctan2(xs, ys))
+        elif xyz_format == 'EEGLab':    
+            thetas = np.degrees(np.arctan2(ys, xs))
+        else:
+            raise ValueError("xyz_format must be 'default' or 'EEGLab', got %r" % (xyz_format,))
+        phis = np.degrees(np.arctan2(zs, r_xy))
+        rads = np.ones(len(info_electrodes))
+        
+        for i, info_electrode in enumerate(info_electrodes):
+            info_electrode['sph_theta'] = thetas[i]
+            info_electrode['sph_phi'] = phis[i]
+            info_electrode['sph_radius'] = rads[i]
         return info_electrodes
 
 def draw_circle_thick(centerxy, radius, im, outline_color, thickness):
@@ -109,12 +155,16 @@ def draw_circle_thick(centerxy, radius, im, outline_color, thickness):
     im : Image with drawn circle
     
     '''    
-    # Solid circle
-    im = draw_circle_center(centerxy, radius, im, outline_color, outline_color)
-    # Inside transparent circle
-    im = draw_circle_center(centerxy, radius-thickness, im, outline_color)
+    _draw_ring(ImageDraw.Draw(im), centerxy, radius, outline_color, thickness)
     return im
 
+def _draw_ring(draw, centerxy, radius, outline_color, thickness):
+    '''
+    Draws only the ring of the circle, the inside of the circle is not touched
+    The ring spans from radius - thickness to radius inclusive, i.e. thickness + 1 pixels
+    '''
+    return _draw_circle(draw, centerxy, radius, outline_color, width=thickness + 1)
+
 def draw_circle_center(centerxy, radius, im, outline_color, fill_color=(255,255,255,0)):
     '''
     Draws as solid circle centered at centerxy
@@ -133,12 +183,55 @@ def draw_circle_center(centerxy, radius, im, outline_color, fill_color=(255,255,
 
     im : Image with drawn circle
     '''
+    _draw_circle(ImageDraw.Draw(im), centerxy, radius, outline_color, fill_color)
+    return im
+
+def _draw_circle(draw, centerxy, radius, outline_color, fill_color=None, width=1):
+    '''
+    Draws a circle centered at centerxy using an existing ImageDraw object 'draw',
+    so the same ImageDraw can be shared by all the drawing calls on one image
+    '''
+    corners = tuple(centerxy - radius) + tuple(centerxy + radius)
+    draw.ellipse(corners, fill=fill_color, outline=outline_color, width=width)
+    return draw
+
+def _clip_box(layer, x0, y0, w, h):
+    '''
+    Clips the box of size ('w', 'h') with top-left corner at ('x0', 'y0') to the borders of 'layer'
+    Returns the slices for 'layer' and for the content of the box, or None if the box is outside
+    '''
+    height, width = layer.shape[:2]
+    x1, y1 = min(x0 + w, width), min(y0 + h, height)
+    cx0, cy0 = max(x0, 0), max(y0, 0)
+    if cx0 >= x1 or cy0 >= y1:
+        return None
+    return ((slice(cy0, y1), slice(cx0, x1)),
+            (slice(cy0 - y0, y1 - y0), slice(cx0 - x0, x1 - x0)))
+
+def draw_dots(layer, points_pxs, radius, fill_color):
+    '''
+    Draws solid circles (dots) centered at each of the 'points_pxs'
+    The dots are stamped directly in the NumPy RGBA array 'layer'
     
+    Parameters
+    ----------
     
-    corners = tuple(centerxy - radius) + tuple(centerxy + radius)
-    draw = ImageDraw.Draw(im)
-    draw.ellipse(corners, fill=fill_color, outline=outline_color)
-    return im
+    layer          : (H, W, 4) uint8 RGBA array to draw in
+    points_pxs     : integer X,Y pixel coordinates for the center of the dots
+    radius         : radius of the dots in pixels
+    fill_color     : color of the dots
+    
+    Returns
+    -------
+
+    layer : array with drawn dots
+    '''
+    disk = np.hypot(*np.ogrid[-radius:radius + 1, -radius:radius + 1]) <= radius
+    for xi, yi in points_pxs:
+        slices = _clip_box(layer, xi - radius, yi - radius, 2 * radius + 1, 2 * radius + 1)
+        if slices is not None:
+            layer[slices[0]][disk[slices[1]]] = fill_color
+    return layer
 
 def pol2cart(theta_radius, centerxy):
     '''
@@ -156,36 +249,131 @@ def pol2cart(theta_radius, centerxy):
     return         : array [X, Y]
         
     '''
-    x = theta_radius[1] * np.cos((theta_radius[0] - 90) *  np.pi / 180)
-    y = theta_radius[1] * np.sin((theta_radius[0] - 90) *  np.pi / 180)  
-    return np.array([x, y]) + centerxy
+    a = (theta_radius[0] - 90.0) * _D2R
+    c, s = math.cos(a), math.sin(a)
+    return np.array([theta_radius[1] * c, theta_radius[1] * s]) + centerxy
 
-def draw_paste(im, im_tmp, point_cart):
+def _pol2cart_tuple(theta, rho, cx, cy):
     '''
-    Pastes an image 'im_tmp' into an image 'im'
-    'im_tmp' is pasted such as its center is located at 'point_cart'
+    Same as pol2cart(), but returns a plain tuple (X, Y) without allocating an array
+    '''
+    a = (theta - 90.0) * _D2R
+    return (rho * math.cos(a) + cx, rho * math.sin(a) + cy)
+
+def pol2cart_batch(thetas, rhos, centerxy):
+    '''
+    Polar 2D cordinates Theta and radius to X,Y coordinates
+    for topoplot plots, for N points at once
     
     Parameters
     ----------
     
-    im         : host image
-    im_tmp     : image to paste
-    point_cart : where the image will be pasted
+    thetas         : array with N Theta values (degrees)
+    rhos           : array with N radius values
+    centerxy       : center of reference 
     
     Returns
     -------
-    im         : host image with pasted image
+    return         : (N, 2) array with [X, Y] for each point
+        
+    '''
+    return pol2cart_rad((np.asarray(thetas, dtype=np.float64) - 90) * _D2R, rhos, centerxy)
 
+def pol2cart_rad(thetas_rad, rhos, centerxy):
     '''
-    size_tmp = im_tmp.size;
-    box = (point_cart[0].astype(int) - size_tmp[0] // 2, 
-           point_cart[1].astype(int) - size_tmp[1] // 2,
-           point_cart[0].astype(int) - size_tmp[0] // 2 + size_tmp[0], 
-           point_cart[1].astype(int) - size_tmp[1] // 2 + size_tmp[1]) 
-    im.paste(im_tmp, box)
-    return im
+    Same as pol2cart_batch(), but Theta values are already in radians
+    and refered to the X axis, i.e. (Theta - 90) * pi / 180
+    
+    Parameters
+    ----------
+    
+    thetas_rad     : array with N Theta values (radians, refered to the X axis)
+    rhos           : array with N radius values
+    centerxy       : center of reference 
+    
+    Returns
+    -------
+    return         : (N, 2) array with [X, Y] for each point
+        
+    '''
+    # inputs are broadcast, e.g. a single radius for all the points
+    thetas_rad, rhos = np.broadcast_arrays(np.atleast_1d(np.asarray(thetas_rad, dtype=np.float64)),
+                                           np.atleast_1d(np.asarray(rhos, dtype=np.float64)))
+    if thetas_rad.ndim != 1:
+        raise ValueError('thetas_rad and rhos must be 1-D, got shape %s' % (thetas_rad.shape,))
+    return np.column_stack((rhos * np.cos(thetas_rad) + centerxy[0],
+                            rhos * np.sin(thetas_rad) + centerxy[1]))
+
+def draw_paste(layer, im_arr, xi, yi, opaque=None):
+    '''
+    Pastes an RGBA array 'im_arr' into the RGBA array 'layer'
+    'im_arr' is pasted such as its center is located at pixel ('xi', 'yi')
+    
+    Parameters
+    ----------
+    
+    layer      : (H, W, 4) uint8 RGBA host array
+    im_arr     : (h, w, 4) uint8 RGBA array to paste
+    xi, yi     : integer pixel coordinates where the image will be pasted
+    opaque     : True if all the pixels of 'im_arr' are opaque, computed if None
+    
+    Returns
+    -------
+    layer      : host array with pasted image
+
+    '''
+    h, w = im_arr.shape[:2]
+    slices = _clip_box(layer, xi - w // 2, yi - h // 2, w, h)
+    if slices is None:
+        return layer
+    fg = im_arr[slices[1]]
+    if opaque is None:
+        opaque = bool((fg[..., 3] == 255).all())
+    if opaque:
+        layer[slices[0]] = fg
+        return layer
+    # straight-alpha "over" compositing, as Image.alpha_composite()
+    bg = layer[slices[0]].astype(np.float32)
+    fg = fg.astype(np.float32)
+    fg_a = fg[..., 3:] / 255
+    bg_a = bg[..., 3:] / 255 * (1 - fg_a)
+    out_a = fg_a + bg_a
+    out_rgb = np.divide(fg[..., :3] * fg_a + bg[..., :3] * bg_a, out_a,
+                        out=np.zeros_like(fg[..., :3]), where=out_a > 0)
+    layer[slices[0]] = np.rint(np.concatenate((out_rgb, out_a * 255), axis=-1)).astype(np.uint8)
+    return layer
+
+def load_image(image_filename, crop_images=[], scale_images=1):
+    '''
+    Loads an image, and crops and scales it
+    
+    Parameters
+    ----------
+    
+    image_filename : fullpath of the image
+    crop_images    : pixels to crop in the original image (without scale), L U R D
+    scale_images   : scale factor for the image
+    
+    Returns
+    -------
+    im_tmp         : loaded image
 
-def plot_in_topoplot(head_radius_pxs, position_filename, image_filenames, xyz_format = 'default', output_filename='./result.png', scale_images=1, crop_images=[]):
+    '''
+    # load image
+    im_tmp = Image.open(image_filename)
+    im_tmp.load()
+    # size 
+    size_im = im_tmp.size
+    # crop
+    if crop_images and any(crop_images):
+        crop_box = (0 + crop_images[0], 0 + crop_images[1], size_im[0] - crop_images[2], size_im[1] - crop_images[3] )    
+        im_tmp = im_tmp.crop(crop_box)
+    # scale
+    if scale_images != 1:
+        im_tmp = im_tmp.resize(( int(im_tmp.size[0] * scale_images), int(im_tmp.size[1] * scale_images)))
+    return im_tmp
+
+def plot_in_topoplot(head_radius_pxs, position_filename, image_filenames, xyz_format = 'default', output_filename='./result.png', scale_images=1, crop_images=[], png_compress_level=1):
     '''
     Pastes an image 'im_tmp' into an image 'im'
     'im_tmp' is pasted such as its center is located at 'point_cart'
@@ -200,6 +388,7 @@ def plot_in_topoplot(head_radius_pxs, position_filename, image_filenames, xyz_fo
     output_filename     : fullpath for the output image
     scale_images        : scale factor for the image to paste
     crop_images         : indicates if the original images (without scale) will be cropped
+    png_compress_level  : zlib compression level (0-9) if the output is a PNG, higher is smaller but slower
     
     Returns
     -------
@@ -219,58 +408,68 @@ def plot_in_topoplot(head_radius_pxs, position_filename, image_filenames, xyz_fo
     im = Image.new('RGBA', tuple(canvas_size), color=(255, 255, 255, 0))
     
     #%% draw head with nose and ears
-    # draw circle
-    im = draw_circle_thick(canvas_center, head_radius_pxs, im, (0, 0, 0, 255), linewidth)
+    # a single ImageDraw is shared by all the drawing calls
     draw = ImageDraw.Draw(im)
+    # draw circle
+    _draw_ring(draw, canvas_center, head_radius_pxs, (0, 0, 0, 255), linewidth)
     # draw nose    
-    nose_points = np.array([[-10, head_radius_pxs - linewidth],
-                            [  0, head_radius_pxs * 1.2],
-                            [ 10, head_radius_pxs - linewidth]]).astype(int)
-    for i_point in range(nose_points.shape[0] - 1):
-        line_tuple_ini = tuple(pol2cart(nose_points[i_point], canvas_center)) 
-        line_tuple_fin = tuple(pol2cart(nose_points[i_point + 1], canvas_center))
-        draw.line(line_tuple_ini + line_tuple_fin, fill=(0, 0, 0, 255), width = linewidth)
+    nose_points = [(-10, int(head_radius_pxs - linewidth)),
+                   (  0, int(head_radius_pxs * 1.2)),
+                   ( 10, int(head_radius_pxs - linewidth))]
+    cx, cy = canvas_center
+    draw.line([_pol2cart_tuple(theta, rho, cx, cy) for theta, rho in nose_points], fill=(0, 0, 0, 255), width = linewidth)
     
     # draw ears
     # values from EEGLAB topoplot function    
-    r = np.array([0.50 , 0.52 , 0.53 , 0.54 ,	0.55 , 0.54 , 0.55 , 0.54 , 0.52 , 0.50]).reshape(-1,1)
-    t = np.array([0.19 , 0.22 , 0.22 , 0.21 ,	0.17 ,-0.01 ,-0.16 ,-0.24 ,-0.26 ,-0.24]).reshape(-1,1)
+    r = np.array([0.50 , 0.52 , 0.53 , 0.54 ,	0.55 , 0.54 , 0.55 , 0.54 , 0.52 , 0.50])
+    t = np.array([0.19 , 0.22 , 0.22 , 0.21 ,	0.17 ,-0.01 ,-0.16 ,-0.24 ,-0.26 ,-0.24])
     
-    # scale to head_radius
-    r = head_radius_pxs * r * 2
-    # angles to Deg and refered to Nose
-    t = (t * 180 / np.pi) + 90
+    # (Theta, radius) for each ear vertex:
+    # angles to Deg and refered to Nose, and radius scaled to head_radius
+    ear_tmpl = np.column_stack((t * _R2D + 90, r * head_radius_pxs * 2))
     
     for side in [1 , -1]:
-        ear_points = np.concatenate((side*t,r), axis=1)
-        for i_point in range(ear_points.shape[0] - 1):
-            line_tuple_ini = tuple(pol2cart(ear_points[i_point], canvas_center)) 
-            line_tuple_fin = tuple(pol2cart(ear_points[i_point + 1], canvas_center))
-            draw.line(line_tuple_ini + line_tuple_fin, fill=(0, 0, 0, 255), width = linewidth)
-    
-    #%% draw points and electrode names for each electrode location
-    for info_electrode in info_electrodes:
-        point_cart = pol2cart((info_electrode['sph_theta'], head_radius_pxs * info_electrode['sph_radius'] * np.cos(info_electrode['sph_phi'] * np.pi / 180 )), canvas_center)
-        draw_circle_center(point_cart, 10, im, (0, 0, 0, 255), (0, 0, 0, 255))
+        # all the vertices of the ear at once, drawn as a single polyline
+        ear_points = pol2cart_batch(side * ear_tmpl[:, 0], ear_tmpl[:, 1], canvas_center)
+        draw.line(list(map(tuple, ear_points)), fill=(0, 0, 0, 255), width = linewidth)
+    
+    #%% electrode locations in the canvas, computed once for all electrodes
+    # Theta converted once to radians refered to the X axis
+    thetas_rad = (np.fromiter((e['sph_theta'] for e in info_electrodes), dtype=np.float64) - 90) * _D2R
+    phis   = np.fromiter((e['sph_phi'] for e in info_electrodes), dtype=np.float64)
+    rads   = np.fromiter((e['sph_radius'] for e in info_electrodes), dtype=np.float64)
+    # projected radius of all the electrodes in a single pass
+    rhos   = np.cos(phis * _D2R)
+    rhos  *= head_radius_pxs * rads
+    points_cart = pol2cart_rad(thetas_rad, rhos, canvas_center)
+    points_pxs  = np.rint(points_cart).astype(int).tolist()
+    
+    #%% draw points and images for each electrode location
+    # dots and images are drawn in a single NumPy RGBA layer, composited once at the end
+    layer = np.zeros((canvas_size[1], canvas_size[0], 4), dtype=np.uint8)
+    draw_dots(layer, points_pxs, 10, (0, 0, 0, 255))
      
-    #%% draw stuff for each electrode location
-    for info_electrode, image_filename in zip(info_electrodes, image_filenames):
-        point_cart = pol2cart((info_electrode['sph_theta'], head_radius_pxs * info_electrode['sph_radius'] * np.cos(info_electrode['sph_phi'] * np.pi / 180 )), canvas_center)
-        # load image
-        im_tmp = Image.open(image_filename)
-        # size 
-        size_im = im_tmp.size
-        # crop
-        if crop_images != []:
-            crop_box = (0 + crop_images[0], 0 + crop_images[1], size_im[0] - crop_images[2], size_im[1] - crop_images[3] )    
-            im_tmp = im_tmp.crop(crop_box)
-        # scale
-        if scale_images != 1:
-            im_tmp = im_tmp.resize(( int(im_tmp.size[0] * scale_images), int(im_tmp.size[1] * scale_images)))
-        # paste im_tmp in specific point
-        im = draw_paste(im, im_tmp, point_cart)
+    # each distinct image is loaded and transformed only once, concurrently
+    # (PIL releases the GIL while decoding)
+    unique_filenames = list(dict.fromkeys(image_filenames[:len(points_pxs)]))
+    images_cache = {}
+    if unique_filenames:
+        with ThreadPoolExecutor(max_workers=min(8, len(unique_filenames))) as executor:
+            images_tmp = executor.map(lambda f: load_image(f, crop_images, scale_images), unique_filenames)
+            for image_filename, im_tmp in zip(unique_filenames, images_tmp):
+                im_arr = np.asarray(im_tmp.convert('RGBA'))
+                images_cache[image_filename] = (im_arr, bool((im_arr[..., 3] == 255).all()))
+    for (xi, yi), image_filename in zip(points_pxs, image_filenames):
+        # paste image in specific point
+        im_arr, opaque = images_cache[image_filename]
+        draw_paste(layer, im_arr, xi, yi, opaque)
+    im = Image.alpha_composite(im, Image.fromarray(layer, 'RGBA'))
         
     #%% save image
-    im.save(output_filename)
+    # format from the extension, PNG encoding options only apply to PNG files
+    if os.path.splitext(output_filename)[1].lower() == '.png':
+        im.save(output_filename, compress_level=png_compress_level, optimize=False)
+    else:
+        im.save(output_filename)
     print(output_filename)
     return output_filename
\ No newline at end of file